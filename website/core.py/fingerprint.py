@@ -1,28 +1,77 @@
-import uuid
+import math
 import numpy as np
+import soundfile
 import settings
+from storage import song_id_for
 from pydub import AudioSegment
-from scipy.signal import spectrogram
+from scipy.fft import rfft, rfftfreq, next_fast_len
+from scipy.signal import resample_poly
+from scipy.signal.windows import hann
 from scipy.ndimage import maximum_filter
+from numba import njit
+
+# window setup is the same for every call, so build it once per process
+_NPERSEG = next_fast_len(int(settings.SAMPLE_RATE * settings.FFT_WINDOW_SIZE))
+# same overlap as scipy.signal.spectrogram's default
+_HOP = _NPERSEG - _NPERSEG // 8
+_WINDOW = hann(_NPERSEG, sym=False).astype(np.float32)
+_FREQS = rfftfreq(_NPERSEG, 1 / settings.SAMPLE_RATE)
+
+# hash layout: 15 bits per frequency (Hz, enough for any SAMPLE_RATE up to 65534) and
+# 16 bits for the anchor to target delta (ms, up to 65 s). Numba freezes these globals into
+# the compiled kernels; they are literals in this file, so editing them also invalidates
+# Numba's disk cache, unlike values derived from settings
+_F_BITS = 15
+_DT_BITS = 16
+_F2_SHIFT = np.uint64(_DT_BITS)
+_F1_SHIFT = np.uint64(_DT_BITS + _F_BITS)
+
+HASH_DTYPE = np.dtype([('h', '<i8'), ('t', '<f4'), ('sid', 'S40')])
+"""Tipo de las filas (hash, time offset, song_id) que devuelve :func:`hash_points`."""
 
 
 def my_spectrogram(audio):
-    """Funcion auxiliar que realiza el espectrograma con los valores dentro de los ajustes"""
-    nperseg = int(settings.SAMPLE_RATE * settings.FFT_WINDOW_SIZE)
-    return spectrogram(audio, settings.SAMPLE_RATE, nperseg=nperseg)
+    """Funcion auxiliar que realiza el espectrograma con los valores dentro de los ajustes.
+    Divide el audio en ventanas de Hann y aplica una FFT real a todas a la vez.
+    :returns: * f - lista de frecuencias
+              * t - lista de tiempos
+              * Sxx - Valor de potencia para cada par frecuencia/tiempo
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    if audio.size < _NPERSEG:
+        # shorter than one segment, pad it out to a single frame
+        audio = np.pad(audio, (0, _NPERSEG - audio.size))
+    frames = np.lib.stride_tricks.sliding_window_view(audio, _NPERSEG)[::_HOP]
+    # the multiplication makes a fresh buffer, so rfft may reuse it
+    Sxx = np.abs(rfft(frames * _WINDOW, workers=settings.FFT_WORKERS, overwrite_x=True)) ** 2
+    f = _FREQS
+    t = (np.arange(Sxx.shape[0]) * _HOP + _NPERSEG / 2) / settings.SAMPLE_RATE
+    # frequencies along the first axis, as scipy.signal.spectrogram returns them
+    return f, t, Sxx.T
 
 
 def file_to_spectrogram(filename):
     """ Calcula el espectrograma del archivo
     Convierte un archivo a mono y hace un remuestreo a :data:`~abracadabra.settings.SAMPLE_RATE` anntes de calcular.Usa :data:`~abracadabra.settings.FFT_WINDOW_SIZE` para tamaño de pantalla.
+    Decodifica con ``soundfile`` cuando libsndfile admite el formato y si no recurre a ``pydub``/ffmpeg.
     :param filename: ruta al archivo para el espectrograma.
     :returns: * f - lista de frecuencias
               * t - lista de tiempos
               * Sxx - Valor de potencia para cada par tiempo/frecuencia
     """
 
-    a = AudioSegment.from_file(filename).set_channels(1).set_frame_rate(settings.SAMPLE_RATE)
-    audio = np.frombuffer(a.raw_data, np.int16)
+    try:
+        audio, sample_rate = soundfile.read(filename, dtype='float32')
+    except RuntimeError:
+        # formats libsndfile can't decode, e.g. m4a, go through ffmpeg
+        a = AudioSegment.from_file(filename).set_channels(1).set_frame_rate(settings.SAMPLE_RATE)
+        audio = np.frombuffer(a.raw_data, np.int16).astype(np.float32, copy=False)
+        return my_spectrogram(audio)
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1, dtype=np.float32)
+    if sample_rate != settings.SAMPLE_RATE:
+        g = math.gcd(sample_rate, settings.SAMPLE_RATE)
+        audio = resample_poly(audio, settings.SAMPLE_RATE // g, sample_rate // g).astype(np.float32, copy=False)
     return my_spectrogram(audio)
 
 
@@ -36,82 +85,113 @@ def find_peaks(Sxx):
     `photutils
     <https://photutils.readthedocs.io/en/stable/_modules/photutils/detection/core.html#find_peaks>`_.
     :param Sxx: El espectrograma.
-    :returns: Una lista de picos en el espectrograma.
+    :returns: Un array ``(N, 2)`` de índices (frecuencia, tiempo) de los picos, del más fuerte al más débil.
     """
 
 
+    # keep the filter and comparisons on 4-byte elements
+    Sxx = Sxx.astype(np.float32, copy=False)
     data_max = maximum_filter(Sxx, size=settings.PEAK_BOX_SIZE, mode='constant', cval=0.0)
     peak_goodmask = (Sxx == data_max)  # good pixels are True
     y_peaks, x_peaks = peak_goodmask.nonzero()
     peak_values = Sxx[y_peaks, x_peaks]
-    i = peak_values.argsort()[::-1]
-    # get co-ordinates into arr
-    j = [(y_peaks[idx], x_peaks[idx]) for idx in i]
     total = Sxx.shape[0] * Sxx.shape[1]
     # in a square with a perfectly spaced grid, we could fit area / PEAK_BOX_SIZE^2 points
     # use point efficiency to reduce this, since it won't be perfectly spaced
     # accuracy vs speed tradeoff
     peak_target = int((total / (settings.PEAK_BOX_SIZE**2)) * settings.POINT_EFFICIENCY)
-    return j[:peak_target]
+    k = min(peak_target, peak_values.size)
+    if k < 1:
+        return np.empty((0, 2), dtype=np.int32)
+    # only the k strongest peaks are kept, so partition before sorting them
+    top = np.argpartition(peak_values, -k)[-k:]
+    top = top[np.argsort(peak_values[top])[::-1]]
+    # get co-ordinates into arr
+    return np.stack([y_peaks[top], x_peaks[top]], axis=1).astype(np.int32)
 
 
 def idxs_to_tf_pairs(idxs, t, f):
-    """Funcion Auxiliar para convertir índices de tiempo/frecuencia en valores."""
-    return np.array([(f[i[0]], t[i[1]]) for i in idxs])
+    """Funcion Auxiliar para convertir índices de tiempo/frecuencia en valores.
+    :returns: Un array ``(N, 2)`` de pares (frecuencia, tiempo) ordenado por tiempo.
+    """
+    idxs = np.asarray(idxs).reshape(-1, 2)
+    pairs = np.stack([f[idxs[:, 0]], t[idxs[:, 1]]], axis=1).astype(np.float32)
+    # target_zone binary searches on the time column
+    return pairs[np.argsort(pairs[:, 1], kind='stable')]
 
 
+@njit(nogil=True, cache=True)
 def hash_point_pair(p1, p2):
-    """Funcion auxiliar para generar un hash a partir de dos puntos de tiempo/frecuencia. """
-    return hash((p1[0], p2[0], p2[1]-p2[1]))
-
-
-def target_zone(anchor, points, width, height, t):
-    """Genera una zona de objetivo como se describe en `el documento de Shazam
-    <https://www.ee.columbia.edu/~dpwe/papers/Wang03-shazam.pdf>`_.
-    Dado un punto de anclaje, produce todos los puntos dentro de un cuadro que comienza `t` segundos después del punto,
-    y tiene ancho `ancho` y alto `alto`.
-    :param anchor: El punto de anclaje
-    :param points: La lista de puntos a buscar
-    :param width: El ancho de la zona de destino
-    :param height: La altura de la zona objetivo
-    :param t: Cuántos segundos después del punto de anclaje debe comenzar la zona objetivo
-    :returns: Da todos los puntos dentro de la zona de objetivo.
+    """Funcion auxiliar para generar un hash a partir de dos puntos de tiempo/frecuencia.
+    Empaqueta la frecuencia del ancla, la del objetivo (en Hz) y la diferencia de tiempo entre
+    ambos (en ms) en un entero de 64 bits.
     """
-
-    x_min = anchor[1] + t
-    x_max = x_min + width
-    y_min = anchor[0] - (height*0.5)
-    y_max = y_min + height
-    for point in points:
-        if point[0] < y_min or point[0] > y_max:
-            continue
-        if point[1] < x_min or point[1] > x_max:
-            continue
-        yield point
+    f1 = np.uint64(np.rint(p1[0]))
+    f2 = np.uint64(np.rint(p2[0]))
+    dt = np.uint64(np.rint((p2[1] - p1[1]) * 1000))
+    return (f1 << _F1_SHIFT) | (f2 << _F2_SHIFT) | dt
+
+
+@njit(nogil=True, cache=True)
+def pair_and_hash(points_ft, target_start, target_t, target_f_half):
+    """Empareja cada ancla con su zona de objetivo como se describe en `el documento de Shazam
+    <https://www.ee.columbia.edu/~dpwe/papers/Wang03-shazam.pdf>`_ y genera los hashes.
+    La zona de un ancla comienza `target_start` segundos después del punto, tiene ancho
+    `target_t` y alto ``2 * target_f_half``.
+    :param points_ft: Array ``(N, 2)`` de puntos (frecuencia, tiempo), ordenado por tiempo.
+    :returns: Dos arrays: los hashes ``uint64`` y la distancia de tiempo del ancla de cada uno.
+    """
+    n = points_ft.shape[0]
+    size = max(16, n * 8)
+    hashes = np.empty(size, np.uint64)
+    offsets = np.empty(size, np.float32)
+    count = 0
+    # anchors are visited in time order, so both zone edges only move forwards
+    lo = 0
+    hi = 0
+    for i in range(n):
+        anchor = points_ft[i]
+        t_min = anchor[1] + target_start
+        t_max = t_min + target_t
+        while lo < n and points_ft[lo, 1] < t_min:
+            lo += 1
+        hi = max(hi, lo)
+        while hi < n and points_ft[hi, 1] <= t_max:
+            hi += 1
+        for j in range(lo, hi):
+            if abs(points_ft[j, 0] - anchor[0]) > target_f_half:
+                continue
+            if count == size:
+                size *= 2
+                grown = np.empty(size, np.uint64)
+                grown[:count] = hashes[:count]
+                hashes = grown
+                grown_offsets = np.empty(size, np.float32)
+                grown_offsets[:count] = offsets[:count]
+                offsets = grown_offsets
+            hashes[count] = hash_point_pair(anchor, points_ft[j])
+            offsets[count] = anchor[1]
+            count += 1
+    return hashes[:count], offsets[:count]
 
 
 def hash_points(points, filename):
     """Genera todos los valores hash para una lista de picos.
-    Itera a través de los picos, generando un hash para cada pico dentro de la zona de objetivo de ese pico.
-    :param points: La lista de picos.
+    Empareja los picos con :func:`pair_and_hash`, generando un hash para cada pico dentro de la zona de objetivo de ese pico.
+    :param points: Array ``(N, 2)`` de picos ordenado por tiempo, como lo devuelve :func:`idxs_to_tf_pairs`.
     :param filename: El nombre de archivo de la canción, usado para generar song_id.
-    :returns: Una lista de tuplas de la forma (hash, time offset, song_id).
+    :returns: Un array estructurado de tipo :data:`HASH_DTYPE` con filas (hash, time offset, song_id).
     """
 
-    hashes = []
-    song_id = uuid.uuid5(uuid.NAMESPACE_OID, filename).int
-    for anchor in points:
-        for target in target_zone(
-            anchor, points, settings.TARGET_T, settings.TARGET_F, settings.TARGET_START
-        ):
-            hashes.append((
-                # hash
-                hash_point_pair(anchor, target),
-                # time offset
-                anchor[1],
-                # filename
-                str(song_id)
-            ))
+    song_id = song_id_for(filename)
+    pair_hashes, offsets = pair_and_hash(
+        points, settings.TARGET_START, settings.TARGET_T, settings.TARGET_F * 0.5
+    )
+    hashes = np.empty(len(pair_hashes), dtype=HASH_DTYPE)
+    # packed hashes stay below 2**63, so the signed view keeps their value
+    hashes['h'] = pair_hashes.view(np.int64)
+    hashes['t'] = offsets
+    hashes['sid'] = song_id.encode()
     return hashes
 
 
@@ -131,11 +211,11 @@ def fingerprint_file(filename):
 def fingerprint_audio(frames):
     """Genera hashes para una serie de marcos de audio.
     Se utiliza al grabar audio.
-    :param frames: Un flujo de audio mono. El tipo de datos es cualquiera que acepte ``scipy.signal.spectrogram``.
+    :param frames: Un flujo de audio mono. Se convierte a ``float32`` antes de la FFT.
     :returns: La salida de :func:`hash_points`.
     """
 
-    f, t, Sxx = my_spectrogram(frames)
+    f, t, Sxx = my_spectrogram(np.asarray(frames, dtype=np.float32))
     peaks = find_peaks(Sxx)
     peaks = idxs_to_tf_pairs(peaks, t, f)
     return hash_points(peaks, "recorded")
\ No newline at end of file
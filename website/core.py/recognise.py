@@ -1,4 +1,5 @@
 import os
+import math
 import logging
 from multiprocessing import Pool, Lock, current_process
 import numpy as np
@@ -6,7 +7,7 @@ from tinytag import TinyTag
 import settings
 from record import record_audio
 from fingerprint import fingerprint_file, fingerprint_audio
-from storage import store_song, get_matches, get_info_for_song_id, song_in_db, checkpoint_db
+from storage import song_id_for, store_song_batch, get_matches, get_info_for_song_id, get_song_ids, song_in_db, checkpoint_db
 
 KNOWN_EXTENSIONS = ["mp3", "wav", "flac", "m4a"]
 
@@ -31,18 +32,32 @@ def register_song(filename):
 
     if song_in_db(filename):
         return
-    hashes = fingerprint_file(filename)
-    song_info = get_song_info(filename)
+    register_song_batch([filename])
+
+
+def register_song_batch(filenames):
+    """Registrar un lote de canciones con una sola escritura en la base de datos.
+    No comprueba si ya están registradas; :func:`register_directory` las filtra antes de repartirlas.
+    Los archivos que fallan se registran en el log y se omiten.
+    :param filenames: Lista de rutas a registrar"""
+
+    items = []
+    for filename in filenames:
+        try:
+            items.append((fingerprint_file(filename), get_song_info(filename)))
+        except Exception:
+            # one unreadable file shouldn't cost the rest of the batch
+            logging.exception(f"{current_process().name} failed to fingerprint {filename}")
     try:
-        logging.info(f"{current_process().name} waiting to write {filename}")
+        logging.info(f"{current_process().name} waiting to write {len(items)} songs")
         with lock:
-            logging.info(f"{current_process().name} writing {filename}")
-            store_song(hashes, song_info)
-            logging.info(f"{current_process().name} wrote {filename}")
+            logging.info(f"{current_process().name} writing {len(items)} songs")
+            store_song_batch(items)
+            logging.info(f"{current_process().name} wrote {len(items)} songs")
     except NameError:
-        logging.info(f"Single-threaded write of {filename}")
+        logging.info(f"Single-threaded write of {len(items)} songs")
         # running single-threaded, no lock needed
-        store_song(hashes, song_info)
+        store_song_batch(items)
 
 
 def register_directory(path):
@@ -60,6 +75,8 @@ def register_directory(path):
 
         global lock
         lock = l
+        # the pool already uses every core, one thread per worker avoids oversubscription
+        settings.FFT_WORKERS = 1
         logging.info(f"Pool init in {current_process().name}")
 
     to_register = []
@@ -69,9 +86,15 @@ def register_directory(path):
                 continue
             file_path = os.path.join(path, root, f)
             to_register.append(file_path)
+    # one query for everything already registered instead of one per file in the workers
+    known = get_song_ids()
+    to_register = [file_path for file_path in to_register if song_id_for(file_path) not in known]
+    # one transaction per batch, but keep every worker busy on small directories
+    batch_size = max(1, min(settings.REGISTER_BATCH_SIZE, math.ceil(len(to_register) / settings.NUM_WORKERS)))
+    batches = [to_register[i:i + batch_size] for i in range(0, len(to_register), batch_size)]
     l = Lock()
     with Pool(settings.NUM_WORKERS, initializer=pool_init, initargs=(l,)) as p:
-        p.map(register_song, to_register)
+        p.map(register_song_batch, batches)
     # speed up future reads
     checkpoint_db()
 
@@ -81,25 +104,23 @@ def score_match(offsets):
     Calcula un histograma de los deltas entre las distancias de tiempo de los hash de la
     muestra grabada y las distancias de tiempo de los hashes coincidentes en la base de datos para una canción.
     Luego, la función devuelve el tamaño del contenedor más grande en este histograma como una puntuación.
-    :param offsets: Lista de pares de distancias para hashes coincidentes
+    :param offsets: Array ``(N, 2)`` de pares de distancias para hashes coincidentes
     :returns: El pico más alto en un histograma de deltas de tiempo
     :rtipo: int
     """
 
     # Use bins spaced 0.5 seconds apart
     binwidth = 0.5
-    tks = list(map(lambda x: x[0] - x[1], offsets))
-    hist, _ = np.histogram(tks,
-                           bins=np.arange(int(min(tks)),
-                                          int(max(tks)) + binwidth + 1,
-                                          binwidth))
-    return np.max(hist)
+    offsets = np.asarray(offsets, dtype=np.float32)
+    tks = offsets[:, 0] - offsets[:, 1]
+    bins = np.floor(tks / binwidth).astype(np.int64)
+    return int(np.bincount(bins - bins.min()).max())
 
 
 def best_match(matches):
     """Para un diccionario de song_id: distancias, devuelve el mejor song_id.
     Califica cada canción en el diccionario de coincidencias y luego devuelve el song_id con la mejor puntuación.
-    :param matches: diccionario de song_id a la lista de pares distancias ​​(db_offset, sample_offset)
+    :param matches: diccionario de song_id al array de pares distancias ​​(db_offset, sample_offset)
        como lo devuelve :func:`~abracadabra.Storage.storage.get_matches`.
     :returns: song_id con la mejor puntuación.
     :rtype: str
@@ -107,7 +128,8 @@ def best_match(matches):
 
     matched_song = None
     best_score = 0
-    for song_id, offsets in matches.items():
+    # largest candidates first, so best_score rises early and the rest can be skipped
+    for song_id, offsets in sorted(matches.items(), key=lambda kv: -len(kv[1])):
         if len(offsets) < best_score:
             # can't be best score, avoid expensive histogram
             continue
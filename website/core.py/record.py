@@ -18,7 +18,7 @@ RECORD_SECONDS = 7
 def record_audio(filename=None):
     """ Graba 10 segundos de audio y, opcionalmente, guárdelo en un archivo
     :param filename: La ruta para guardar el audio (opcional).
-    :returns: El flujo de audio con los parámetros definidos en este módulo.
+    :returns: El flujo de audio con los parámetros definidos en este módulo, como ``float32``.
     """
     p = pyaudio.PyAudio()
 
@@ -30,14 +30,12 @@ def record_audio(filename=None):
 
     print("* recording")
 
-    frames = []
-    write_frames = []
+    num_chunks = int(RATE / CHUNK * RECORD_SECONDS)
+    frames = np.empty(num_chunks * CHUNK, dtype=np.int16)
 
-    for i in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-        data = stream.read(CHUNK)
-        frames.append(np.frombuffer(data, dtype=np.int16))
-        if filename is not None:
-            write_frames.append(data)
+    for i in range(0, num_chunks):
+        # pyaudio has no readinto, so copy each chunk straight into place
+        frames[i * CHUNK:(i + 1) * CHUNK] = np.frombuffer(stream.read(CHUNK), dtype=np.int16)
 
     print("* done recording")
 
@@ -50,10 +48,10 @@ def record_audio(filename=None):
         wf.setnchannels(CHANNELS)
         wf.setsampwidth(p.get_sample_size(FORMAT))
         wf.setframerate(RATE)
-        wf.writeframes(b''.join(frames))
+        wf.writeframes(frames.tobytes())
         wf.close()
 
-    
-    return np.hstack(frames)
+
+    return frames.astype(np.float32)
 
 
@@ -1,3 +1,5 @@
+import os
+
 SAMPLE_RATE = 44100
 """ Cuando se toma la huella digital de un archivo, es remuestreado a SAMPLE_RATE Hz.
 Frecuencias de muestreo más altas significan una mayor precisión en el reconocimiento, pero también un reconocimiento más lento
@@ -39,4 +41,13 @@ DB_PATH = "hash.db"
 """ Ruta al archivo de base de datos a utilizar. """
 
 NUM_WORKERS = 24
-""" Número de trabajadores a utilizar al registrar canciones. """
\ No newline at end of file
+""" Número de trabajadores a utilizar al registrar canciones. """
+
+REGISTER_BATCH_SIZE = 64
+""" Número máximo de canciones que un trabajador registra en una sola transacción. """
+
+FFT_WORKERS = int(os.environ.get("FFT_WORKERS", -1))
+""" Número de hilos para la FFT del espectrograma; -1 usa todos los núcleos. Se puede fijar con la
+variable de entorno ``FFT_WORKERS``. Los trabajadores de :func:`~abracadabra.recognise.register_directory`
+usan 1 para no competir entre ellos por la CPU.
+"""
\ No newline at end of file
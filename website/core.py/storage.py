@@ -1,9 +1,25 @@
 import uuid
+import logging
 import sqlite3
+import numpy as np
+from itertools import chain
 from collections import defaultdict
 from contextlib import contextmanager
 import settings
 
+HASH_VERSION = 1
+"""Versión de la codificación de los hashes. Hay que aumentarla al cambiar
+:func:`~abracadabra.fingerprint.hash_point_pair`, ya que los hashes de otra versión nunca coinciden;
+:func:`setup_db` descarta los antiguos."""
+
+
+def song_id_for(filename):
+    """Calcula el ``song_id`` de una canción a partir de su ruta.
+    :param filename: La ruta al archivo.
+    :rtype: str
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, filename).int)
+
 
 @contextmanager
 def get_cursor():
@@ -12,6 +28,8 @@ def get_cursor():
     """
     try:
         conn = sqlite3.connect(settings.DB_PATH, timeout=30)
+        # per-connection setting; safe with WAL, only the checkpoint fsyncs
+        conn.execute("PRAGMA synchronous=NORMAL")
         yield conn, conn.cursor()
     finally:
         conn.close()
@@ -20,17 +38,37 @@ def get_cursor():
 def setup_db():
     """Crear la base de datos y las tablas.
     Para ser ejecutado una vez a través de un shell interactivo.
+
+    Si la base de datos se creó con otra :data:`HASH_VERSION`, se borran sus hashes y canciones,
+    y hay que volver a registrar todas las canciones.
     """
     with get_cursor() as (conn, c):
-        c.execute("CREATE TABLE IF NOT EXISTS hash (hash int, offset real, song_id text)")
+        # the primary key b-tree holds the rows themselves, clustered by hash, which
+        # dramatically speeds up recognition
+        hash_schema = "(hash int, song_id text, offset real, PRIMARY KEY (hash, song_id, offset)) WITHOUT ROWID"
+        c.execute("PRAGMA user_version")
+        old_version = c.fetchone()[0]
+        if old_version != HASH_VERSION:
+            # hashes from another encoding (or the old rowid layout) can never match again,
+            # so drop them and forget their songs so they get registered again
+            c.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='song_info'")
+            if c.fetchone()[0]:
+                c.execute("SELECT count(DISTINCT song_id) FROM song_info")
+                dropped = c.fetchone()[0]
+                logging.warning(f"Hash version changed from {old_version} to {HASH_VERSION}, "
+                                f"dropping {dropped} songs; they must be registered again")
+            c.execute("DROP TABLE IF EXISTS hash")
+            c.execute("DROP TABLE IF EXISTS song_info")
+            c.execute(f"PRAGMA user_version={HASH_VERSION}")
+        c.execute(f"CREATE TABLE IF NOT EXISTS hash {hash_schema}")
         c.execute("CREATE TABLE IF NOT EXISTS song_info (artist text, album text, title text, song_id text)")
-        # dramatically speed up recognition
-        c.execute("CREATE INDEX IF NOT EXISTS idx_hash ON hash (hash)")
         # faster write mode that enables greater concurrency
         # https://sqlite.org/wal.html
         c.execute("PRAGMA journal_mode=WAL")
         # reduce load at a checkpoint and reduce chance of a timeout
         c.execute("PRAGMA wal_autocheckpoint=300")
+        # let the planner know about the table layout
+        c.execute("ANALYZE")
 
 
 def checkpoint_db():
@@ -45,14 +83,29 @@ def song_in_db(filename):
     :rtype: booleano
     """
     with get_cursor() as (conn, c):
-        song_id = str(uuid.uuid5(uuid.NAMESPACE_OID, filename).int)
-        c.execute("SELECT * FROM song_info WHERE song_id=?", (song_id,))
+        c.execute("SELECT * FROM song_info WHERE song_id=?", (song_id_for(filename),))
         return c.fetchone() is not None
 
 
+def get_song_ids():
+    """Obtener los ``song_id`` de todas las canciones registradas.
+    :rtype: set(str)
+    """
+    with get_cursor() as (conn, c):
+        c.execute("SELECT song_id FROM song_info")
+        return {row[0] for row in c.fetchall()}
+
+
+def _hash_rows(hashes):
+    """Recorre un array de :func:`~abracadabra.fingerprint.hash_points` como tuplas (hash, time offset, song_id)
+    de tipos de Python, sin construir una lista intermedia.
+    """
+    return zip(hashes['h'].tolist(), hashes['t'].tolist(), map(bytes.decode, hashes['sid'].tolist()))
+
+
 def store_song(hashes, song_info):
     """Registrar una canción en la base de datos.
-    :param hashes: Una lista de tuplas de la forma (hash, time offset, song_id) devuelta por
+    :param hashes: El array de filas (hash, time offset, song_id) devuelto por
         :func:`~abracadabra.fingerprint.fingerprint_file`.
     :param song_info: Una tupla de forma (artista, álbum, título) que describe la canción.
     """
@@ -62,32 +115,52 @@ def store_song(hashes, song_info):
         # or maybe widen the target zone
         return
     with get_cursor() as (conn, c):
-        c.executemany("INSERT INTO hash VALUES (?, ?, ?)", hashes)
+        c.executemany("INSERT OR IGNORE INTO hash (hash, offset, song_id) VALUES (?, ?, ?)", _hash_rows(hashes))
         insert_info = [i if i is not None else "Unknown" for i in song_info]
-        c.execute("INSERT INTO song_info VALUES (?, ?, ?, ?)", (*insert_info, hashes[0][2]))
+        c.execute("INSERT INTO song_info VALUES (?, ?, ?, ?)", (*insert_info, hashes['sid'][0].decode()))
+        conn.commit()
+
+
+def store_song_batch(items):
+    """Registrar varias canciones en la base de datos en una sola transacción.
+    :param items: Una lista de tuplas de la forma (hashes, song_info), con los mismos valores que
+        recibe :func:`store_song`.
+    """
+    items = [(hashes, song_info) for hashes, song_info in items if len(hashes) > 0]
+    if not items:
+        return
+    song_infos = []
+    for hashes, song_info in items:
+        insert_info = [i if i is not None else "Unknown" for i in song_info]
+        song_infos.append((*insert_info, hashes['sid'][0].decode()))
+    with get_cursor() as (conn, c):
+        # take the write lock up front instead of upgrading mid-transaction
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany("INSERT OR IGNORE INTO hash (hash, offset, song_id) VALUES (?, ?, ?)", chain.from_iterable(_hash_rows(h) for h, _ in items))
+        c.executemany("INSERT INTO song_info VALUES (?, ?, ?, ?)", song_infos)
         conn.commit()
 
 
 def get_matches(hashes, threshold=5):
     """Obtenga canciones coincidentes para un conjunto de hashes.
-    :param hashes: Una lista de hashes devueltos por
+    :param hashes: El array de hashes devuelto por
         :func:`~abracadabra.fingerprint.fingerprint_file`.
     :param umbral: Devuelve canciones que tienen más de coincidencias de ``umbral``.
-    :returns: Un diccionario mapeando ``song_id`` a una lista de tuplas de compensación de tiempo. Las tuplas son de
+    :returns: Un diccionario mapeando ``song_id`` a un array ``(N, 2)`` de compensaciones de tiempo. Las filas son de
         el formulario (desplazamiento de resultado, desplazamiento hash original).
-    :rtype: dict(str: lista(tupla(flotante, flotante)))
+    :rtype: dict(str: numpy.ndarray)
     """
-    h_dict = {}
-    for h, t, _ in hashes:
-        h_dict[h] = t
-    in_values = f"({','.join([str(h[0]) for h in hashes])})"
     with get_cursor() as (conn, c):
-        c.execute(f"SELECT hash, offset, song_id FROM hash WHERE hash IN {in_values}")
+        # join against the sample's hashes so that repeated hashes keep every offset
+        c.execute("CREATE TEMP TABLE q (h INTEGER, t REAL)")
+        c.executemany("INSERT INTO q VALUES (?, ?)", zip(hashes['h'].tolist(), hashes['t'].tolist()))
+        c.execute("SELECT hash.offset, q.t, hash.song_id FROM q JOIN hash ON hash.hash = q.h")
         results = c.fetchall()
     result_dict = defaultdict(list)
-    for r in results:
-        result_dict[r[2]].append((r[1], h_dict[r[0]]))
-    return result_dict
+    for db_offset, sample_offset, song_id in results:
+        result_dict[song_id].append((db_offset, sample_offset))
+    # scoring works on whole arrays
+    return {song_id: np.asarray(offsets, dtype=np.float32) for song_id, offsets in result_dict.items()}
 
 
 def get_info_for_song_id(song_id):